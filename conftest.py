@@ -0,0 +1 @@
+""" Root conftest, makes pytest put repository root on sys.path so tests import goods_duty_optimizer. """
@@ -1,3 +1,3 @@
 """ Main package of goods-duty-optimier project. """
-from .model import Settings, Solution, calculate_cost, generate_random_settings
+from .model import Settings, Solution, calculate_cost, generate_random_settings, prepare_settings
 from .bees_algorithm import BeesSolver, stop_delta, stop_iterations
@@ -1,10 +1,130 @@
-import random
-import copy
-from typing import List, Callable
+from typing import Callable, Optional, Union
 
 import numpy as np
-
-from .model import Solution, Settings, calculate_cost, generate_random_solution
+from numba import njit, prange
+
+from .model import Solution, Settings, calculate_costs, generate_random_trucks_allocations, \
+    generate_random_goods_allocations, trucks_allocation_dtype, prepare_settings
+
+
+@njit(cache=True)
+def _pick_positive_nb(values, n):
+    """ Returns index of n-th positive value. """
+    for i in range(values.shape[0]):
+        if values[i] > 0:
+            if n == 0:
+                return i
+            n -= 1
+    return -1
+
+
+@njit(cache=True)
+def _draw_index_nb(u, n):
+    """ Maps number drawn uniformly from [0, 1) to integer drawn uniformly from [0, n). """
+    i = int(u * n)
+    return i if i < n else n - 1
+
+
+@njit(cache=True)
+def _calc_spaces_nb(goods_allocation, truck_capacity, spaces):
+    """ Calculates (into spaces array of shape (p)) free space in each truck. """
+    for i in range(goods_allocation.shape[0]):
+        spaces[i] = truck_capacity
+        for k in range(goods_allocation.shape[1]):
+            spaces[i] -= goods_allocation[i, k]
+
+
+@njit(cache=True)
+def _mutate_goods_allocation_nb(trucks_allocation, goods_allocation, duties, draws, spaces):
+    """
+    Mutates (inplace) goods allocation by randomly moving goods from one truck to another while ensuring that
+    restrictions are still met. Randomness is taken from array draws of 4 numbers from [0, 1) and array spaces of
+    shape (p) holds free space in each truck, which is updated (inplace) for the two trucks that changed.
+
+    :returns: change of cost of the solution
+    """
+    trucks, goods_types = goods_allocation.shape
+
+    # count trucks with free space
+    free = 0
+    for i in range(trucks):
+        if spaces[i] > 0:
+            free += 1
+
+    # select random column - goods type
+    k = _draw_index_nb(draws[0], goods_types)
+    column = goods_allocation[:, k]
+    loaded = 0
+    for i in range(trucks):
+        if column[i] > 0:
+            loaded += 1
+
+    # nothing can be moved if all trucks are full or there are no goods of this type
+    if free == 0 or loaded == 0:
+        return 0.0
+
+    # select random truck that has free space and random truck that has some goods of type k
+    t_to = _pick_positive_nb(spaces, _draw_index_nb(draws[1], free))
+    t_from = _pick_positive_nb(column, _draw_index_nb(draws[2], loaded))
+
+    # calculate how much can be moved of this type between these trucks, only whole units are moved
+    available, space = column[t_from], spaces[t_to]
+    max_amount = int(available if available < space else space)
+    if max_amount < 1:
+        return 0.0
+
+    # move random amount from [1, max_amount]
+    amount = 1 + _draw_index_nb(draws[3], max_amount)
+    goods_allocation[t_from, k] -= amount
+    goods_allocation[t_to, k] += amount
+    spaces[t_from] += amount
+    spaces[t_to] -= amount
+
+    # only duties of moved goods change
+    c_to, c_from = trucks_allocation[t_to], trucks_allocation[t_from]
+    return amount * (np.float64(duties[c_to, k]) - np.float64(duties[c_from, k]))
+
+
+@njit(cache=True)
+def _mutate_trucks_allocation_nb(trucks_allocation, goods_allocation, duties, distances, fuel_cost, i, c):
+    """
+    Mutates (inplace) trucks allocation by sending i-th truck to c-th crossing.
+
+    :returns: change of cost of the solution
+    """
+    old = trucks_allocation[i]
+    trucks_allocation[i] = c
+
+    # only fuel and duties of goods in this truck change
+    delta = fuel_cost * (np.float64(distances[c]) - np.float64(distances[old]))
+    for k in range(goods_allocation.shape[1]):
+        delta += goods_allocation[i, k] * (np.float64(duties[c, k]) - np.float64(duties[old, k]))
+    return delta
+
+
+@njit(cache=True, parallel=True)
+def _mutate_solutions_nb(trucks_allocations, goods_allocations, costs, duties, distances, fuel_cost, truck_capacity,
+                         goods_draws, trucks_indices, crossings, spaces):
+    """
+    Mutates (inplace) each solution in block of N solutions in parallel and updates (inplace) their costs.
+    Array goods_draws of shape (N, goods_mutations, 4) holds randomness for every goods mutation, arrays
+    trucks_indices and crossings of shape (N, trucks_mutations) define every trucks mutation and array spaces of
+    shape (N, p) is used as a buffer for free space in trucks of each solution, calculated once per solution and
+    carried across its goods mutations.
+    """
+    for n in prange(goods_allocations.shape[0]):
+        cost = costs[n]
+        _calc_spaces_nb(goods_allocations[n], truck_capacity, spaces[n])
+        for j in range(goods_draws.shape[1]):
+            cost += _mutate_goods_allocation_nb(
+                trucks_allocations[n], goods_allocations[n], duties, goods_draws[n, j], spaces[n]
+            )
+        for j in range(trucks_indices.shape[1]):
+            cost += _mutate_trucks_allocation_nb(
+                trucks_allocations[n], goods_allocations[n], duties, distances, fuel_cost,
+                trucks_indices[n, j], crossings[n, j]
+            )
+        costs[n] = cost
 
 
 class BeesSolver:
@@ -13,7 +133,8 @@ class BeesSolver:
     def __init__(self, settings: Settings, population_size: int,
                  goods_mutations: int, trucks_mutations: int,
                  elite_sites: int, normal_sites: int,
-                 elite_site_size: int, normal_site_size: int):
+                 elite_site_size: int, normal_site_size: int,
+                 seed: Optional[Union[int, np.random.Generator]] = None):
         """
         Creates bees solver.
 
@@ -25,8 +146,10 @@ class BeesSolver:
         :param normal_sites: number of solutions that will be selected as normal
         :param elite_site_size:
         :param normal_site_size:
+        :param seed: seed or generator used for all random numbers of this solver, random seed if not given
         """
-        self.settings = settings
+        # duties and distances are kept as contiguous float32 arrays to halve memory traffic of cost evaluation
+        self.settings = prepare_settings(settings)
         self.population_size = population_size
         self.goods_mutations = goods_mutations
         self.trucks_mutations = trucks_mutations
@@ -35,101 +158,133 @@ class BeesSolver:
         self.elite_site_size = elite_site_size
         self.normal_site_size = normal_site_size
 
-        self.population: List[Solution] = []
-
-    def _mutate_trucks_allocation(self, solution: Solution):
-        """
-        Mutates (inplace) trucks allocation in given solution by randomly replacing one allocation with random value.
-        """
-        i = random.randrange(self.settings.trucks_number)
-        c = random.randrange(self.settings.crossings_number)
-        solution.trucks_allocation[i] = c
-
-    def _mutate_goods_allocation(self, solution: Solution):
-        """
-        Mutates (inplace) goods allocation in given solution by randomly moving goods from one truck to another while
-        ensuring that restrictions are still met.
-        """
-
-        # calculate free space in each truck
-        spaces = self.settings.truck_capacity - solution.goods_allocation.sum(axis=1)
-
-        # select random column - goods type
-        k = random.randrange(self.settings.goods_types_number)
-
-        # select random truck that has free space
-        t_to = random.choice(np.argwhere(spaces > 0).flatten())
+        # population is stored as two arrays, i-th solution consists of i-th trucks and goods allocations, they are
+        # left uninitialized until init_population is called
+        self._initialized = False
+        self.trucks_population = np.empty(
+            (population_size, settings.trucks_number), dtype=trucks_allocation_dtype(settings)
+        )
+        self.goods_population = np.empty(
+            (population_size, settings.trucks_number, settings.goods_types_number), dtype=np.float32
+        )
+        self.costs = np.empty(population_size)
 
-        # select random truck that has some goods of type k
-        t_from = random.choice(np.argwhere(solution.goods_allocation[:, k] > 0).flatten())
+        # neighbours of all sites are searched together, i-th site owns rows from bounds[i] to bounds[i+1]
+        sites_sizes = [elite_site_size] * elite_sites + [normal_site_size] * normal_sites
+        self._sites_bounds = np.concatenate(([0], np.cumsum(sites_sizes, dtype=np.int64)))
+        self._neighbours_sites = np.repeat(np.arange(len(sites_sizes)), sites_sizes)
 
-        # calculate how much can be moved of this type between these trucks
-        max_amount = min(
-            solution.goods_allocation[t_from, k],    # available goods in truck that we take from
-            spaces[t_to],  # available space in truck that we put
+        # buffers for neighbours of all sites, reused by every neighbourhood search
+        neighbours_size = self._sites_bounds[-1]
+        self._trucks_neighbours = np.empty(
+            (neighbours_size, settings.trucks_number), dtype=trucks_allocation_dtype(settings)
+        )
+        self._goods_neighbours = np.empty(
+            (neighbours_size, settings.trucks_number, settings.goods_types_number), dtype=np.float32
         )
+        self._costs_neighbours = np.empty(neighbours_size)
 
-        # move random amount
-        amount = random.randint(1, max_amount)
-        solution.goods_allocation[t_from, k] -= amount
-        solution.goods_allocation[t_to, k] += amount
+        # buffer for free space in each truck used by goods mutations, separate for each neighbour
+        self._spaces = np.empty((neighbours_size, settings.trucks_number), dtype=np.float32)
 
-    def _mutate_solution(self, solution: Solution):
+        # generator of all random numbers needed by mutations and random solutions, drawn in bulk once per step
+        self.rng = np.random.default_rng(seed)
+
+    def _mutate_solutions(self, trucks_allocations: np.ndarray, goods_allocations: np.ndarray, costs: np.ndarray):
         """
-        Mutates (inplace) solution by applying goods and trucks allocation mutations specified number of times.
+        Mutates (inplace) block of solutions by applying goods and trucks allocation mutations specified number of
+        times to each of them, updating (inplace) their costs along the way.
         """
+        rows = goods_allocations.shape[0]
+        _mutate_solutions_nb(
+            trucks_allocations, goods_allocations, costs,
+            self.settings.duties, self.settings.distances, self.settings.fuel_cost, self.settings.truck_capacity,
+            self.rng.random((rows, self.goods_mutations, 4)),
+            self.rng.integers(0, self.settings.trucks_number, (rows, self.trucks_mutations)),
+            self.rng.integers(0, self.settings.crossings_number, (rows, self.trucks_mutations)),
+            self._spaces
+        )
 
-        for _ in range(self.goods_mutations):
-            self._mutate_goods_allocation(solution)
-
-        for _ in range(self.trucks_mutations):
-            self._mutate_trucks_allocation(solution)
-
-    def _find_best_neighbour(self, solution: Solution, neighbours_count: int) -> Solution:
+    def _find_best_neighbours(self):
         """
-        Finds best neighbour from a randomly mutated population of neighbours of given solution.
-
-        :returns: best solution from neighbourhood, or given solution if it was the best
+        Replaces (inplace) solution of each site with the best neighbour from a randomly mutated population of its
+        neighbours, or leaves it unchanged if it was the best. Neighbours of all sites are mutated in parallel.
         """
 
-        # create neighbours
-        neighbours = [copy.deepcopy(solution) for _ in range(neighbours_count)]
-
-        # mutate neighbours
-        for n in neighbours:
-            self._mutate_solution(n)
-
-        # append original solution to also be included in evaluation
-        neighbours.append(solution)
+        # create neighbours of all sites
+        np.take(self.trucks_population, self._neighbours_sites, axis=0, out=self._trucks_neighbours)
+        np.take(self.goods_population, self._neighbours_sites, axis=0, out=self._goods_neighbours)
+        np.take(self.costs, self._neighbours_sites, out=self._costs_neighbours)
+
+        # mutate neighbours, their costs are updated together with each mutation
+        self._mutate_solutions(self._trucks_neighbours, self._goods_neighbours, self._costs_neighbours)
+
+        # store the best neighbour of each site
+        costs = self._costs_neighbours
+        for site in range(len(self._sites_bounds) - 1):
+            start, end = self._sites_bounds[site], self._sites_bounds[site + 1]
+            if start == end:
+                continue
+            best = start + costs[start:end].argmin()
+            if costs[best] <= self.costs[site]:
+                self.trucks_population[site] = self._trucks_neighbours[best]
+                self.goods_population[site] = self._goods_neighbours[best]
+                self.costs[site] = costs[best]
+
+    def _generate_random_solutions(self, start: int):
+        """ Replaces (inplace) all solutions from given index to the end of population with random ones. """
+        size = self.population_size - start
+        self.trucks_population[start:] = generate_random_trucks_allocations(self.settings, size, self.rng)
+        self.goods_population[start:] = generate_random_goods_allocations(self.settings, size, self.rng)
+        self.costs[start:] = calculate_costs(
+            self.trucks_population[start:], self.goods_population[start:], self.settings
+        )
 
-        # find and return best neighbour
-        return sorted(neighbours, key=lambda sol: calculate_cost(sol, self.settings))[0]
+    def _check_initialized(self):
+        """ Raises IndexError if population was not generated yet, as its arrays hold uninitialized memory. """
+        if not self._initialized:
+            raise IndexError('population is empty, call init_population first')
 
     def simulate_population(self):
         """ Applies one step of bees algorithm. """
-
-        # sort population
-        self.population.sort(key=lambda sol: calculate_cost(sol, self.settings))
-
-        # find best neighbours in elite sites
-        for i in range(0, self.elite_sites):
-            self.population[i] = self._find_best_neighbour(self.population[i], self.elite_site_size)
-
-        # find best neighbours in normal sites
-        for i in range(self.elite_sites, self.elite_sites + self.normal_sites):
-            self.population[i] = self._find_best_neighbour(self.population[i], self.normal_site_size)
+        self._check_initialized()
+
+        # move best solutions in sorted order to the sites, order of other ones does not matter as they are replaced
+        sites = self.elite_sites + self.normal_sites
+        if sites >= self.population_size:
+            best = self.costs.argsort(kind='stable')
+        elif sites > 0:
+            best = np.argpartition(self.costs, sites - 1)[:sites]
+            best = best[self.costs[best].argsort(kind='stable')]
+        else:
+            best = np.empty(0, dtype=np.int64)
+        self.trucks_population[:best.size] = self.trucks_population[best]
+        self.goods_population[:best.size] = self.goods_population[best]
+        self.costs[:best.size] = self.costs[best]
+
+        # find best neighbours in elite and normal sites
+        self._find_best_neighbours()
 
         # replace all other solutions with random ones
-        for i in range(self.elite_sites + self.normal_sites, len(self.population)):
-            self.population[i] = generate_random_solution(self.settings)
+        self._generate_random_solutions(sites)
 
     def init_population(self):
         """ Generates random population. """
-        self.population = [generate_random_solution(self.settings) for _ in range(self.population_size)]
+        self._generate_random_solutions(0)
+        self._initialized = True
 
     def current_cost(self) -> float:
         """ Returns current cost of first solution from population. """
-        return calculate_cost(self.population[0], self.settings)
+        self._check_initialized()
+        return self.costs[0]
+
+    def current_solution(self) -> Solution:
+        """ Returns first solution from population. """
+        self._check_initialized()
+        return Solution(
+            trucks_allocation=self.trucks_population[0].copy(),
+            goods_allocation=self.goods_population[0].copy()
+        )
 
     def find_best_solution(self, stop_func: Callable[[int, float, float], bool]) -> Solution:
         """
@@ -145,13 +300,18 @@ class BeesSolver:
         # create random population
         self.init_population()
 
-        # while stop function returns true simulate population
-        while not stop_func(loops, last_cost, self.current_cost()):
+        # while stop function returns true simulate population, cost is read once per loop and methods are bound
+        # to locals before the loop
+        simulate_population = self.simulate_population
+        current_cost = self.current_cost
+        new_cost = current_cost()
+        while not stop_func(loops, last_cost, new_cost):
             loops += 1
-            last_cost = self.current_cost()
-            self.simulate_population()
+            last_cost = new_cost
+            simulate_population()
+            new_cost = current_cost()
 
-        return self.population[0]
+        return self.current_solution()
 
 
 def stop_delta(delta: float):
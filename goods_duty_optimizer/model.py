@@ -1,7 +1,16 @@
+import heapq
 import random
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
 import numpy as np
+from numba import njit, prange
+
+# default generator (PCG64) used for random generation of solutions instead of the legacy global state,
+# generation functions accept their own generator for reproducible or per-worker streams
+_rng = np.random.default_rng()
+
+# maximal number of goods allocations drawn at once by batch generation
+_GENERATION_CHUNK_SIZE = 4096
 
 
 # ==========================================================
@@ -25,6 +34,15 @@ class Solution(NamedTuple):
     goods_allocation: np.ndarray    # b - array of shape (p, m) that defines allocation of goods for given truck
 
 
+def trucks_allocation_dtype(settings: Settings) -> type:
+    """ Returns the smallest integer type that can hold index of any crossing, used for trucks allocations """
+    if settings.crossings_number <= np.iinfo(np.int8).max + 1:
+        return np.int8
+    if settings.crossings_number <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
 # ==========================================================
 #  TYPES VALIDATION
 # ==========================================================
@@ -46,65 +64,245 @@ def validate_solution(solution: Solution, settings: Settings) -> bool:
 # ==========================================================
 #  COST CALCULATION
 # ==========================================================
+# types of arrays used in cost calculation, inputs are converted to them before calling compiled kernels
+_COST_SIGNATURES = [
+    'float64(%s[::1], %s[:, ::1], %s[:, ::1], %s[::1], float64)' % (trucks, goods, goods, goods)
+    for trucks in ('int8', 'int16', 'int32')
+    for goods in ('float32', 'float64')
+]
+
+
+def _float_dtype(*arrays: np.ndarray) -> type:
+    """ Returns float32 if all given arrays are float32 and float64 otherwise """
+    return np.float32 if all(array.dtype == np.float32 for array in arrays) else np.float64
+
+
+def _check_trucks_allocations(trucks_allocations: np.ndarray, settings: Settings):
+    """
+    Raises IndexError if any truck is allocated to crossing out of range. Compiled kernels do not check bounds and
+    casting to trucks_allocation_dtype would wrap large indices, so it has to be done before both.
+    """
+    if trucks_allocations.size and (trucks_allocations.min() < 0
+                                    or trucks_allocations.max() >= settings.crossings_number):
+        raise IndexError('trucks allocation contains crossing out of range [0, %d)' % settings.crossings_number)
+
+
+@njit(_COST_SIGNATURES, cache=True, fastmath=True)
+def _calc_cost_nb(trucks_allocation, goods_allocation, duties, distances, fuel_cost):
+    """
+    Calculates cost of given allocations with plain loops, without creating any temporary arrays. Compiled eagerly
+    for fixed signatures, so calls skip type dispatch and compilation.
+    """
+    cost = 0.0
+    for i in range(goods_allocation.shape[0]):
+        c = trucks_allocation[i]
+        # duties of single truck are summed separately so the inner loop has its own accumulator
+        truck_cost = 0.0
+        for k in range(goods_allocation.shape[1]):
+            truck_cost += goods_allocation[i, k] * duties[c, k]
+        cost += truck_cost + fuel_cost * distances[c]
+    return cost
+
+
+@njit(cache=True, parallel=True)
+def _calc_costs_nb(trucks_allocations, goods_allocations, duties, distances, fuel_cost, costs):
+    """
+    Calculates (into costs array) cost of each allocation in block, reading duties directly from settings.
+    Solutions are evaluated in parallel, as the block is the largest dimension of the problem.
+    """
+    for n in prange(goods_allocations.shape[0]):
+        costs[n] = _calc_cost_nb(trucks_allocations[n], goods_allocations[n], duties, distances, fuel_cost)
+
+
+def prepare_settings(settings: Settings) -> Settings:
+    """
+    Returns copy of settings with duties and distances stored as C-contiguous float32 arrays, which is the layout
+    expected by cost evaluation. Converting settings once per run lets cost functions use them without copying.
+    """
+    return settings._replace(
+        duties=np.ascontiguousarray(settings.duties, dtype=np.float32),
+        distances=np.ascontiguousarray(settings.distances, dtype=np.float32)
+    )
+
+
 def calculate_cost(solution: Solution, settings: Settings) -> float:
-    """ Calculates cost of given solution """
-    duties_cost = np.sum(solution.goods_allocation * settings.duties[solution.trucks_allocation, :])
-    fuel_cost = np.sum(settings.fuel_cost * settings.distances[solution.trucks_allocation])
-    return duties_cost + fuel_cost
+    """
+    Calculates cost of given solution.
+
+    Compiled kernel reads C-contiguous arrays, trucks allocation of type given by trucks_allocation_dtype and other
+    arrays all float32 or all float64, arrays of other layout or type are copied on every call. Use settings from
+    prepare_settings and allocations in types used by random generation to avoid these copies.
+    Raises IndexError if any truck is allocated to crossing out of range.
+    """
+    trucks_allocation, goods_allocation = np.asarray(solution.trucks_allocation), np.asarray(solution.goods_allocation)
+    duties, distances = np.asarray(settings.duties), np.asarray(settings.distances)
+    _check_trucks_allocations(trucks_allocation, settings)
+    dtype = _float_dtype(goods_allocation, duties, distances)
+    return _calc_cost_nb(
+        np.ascontiguousarray(trucks_allocation, dtype=trucks_allocation_dtype(settings)),
+        np.ascontiguousarray(goods_allocation, dtype=dtype),
+        np.ascontiguousarray(duties, dtype=dtype),
+        np.ascontiguousarray(distances, dtype=dtype),
+        float(settings.fuel_cost)
+    )
+
+
+def calculate_costs(trucks_allocations: np.ndarray, goods_allocations: np.ndarray, settings: Settings) -> np.ndarray:
+    """
+    Calculates costs of many solutions at once.
+
+    Arrays are expected in the same layout and types as in calculate_cost, otherwise they are copied.
+
+    :param trucks_allocations: array of shape (N, p) with trucks allocations of N solutions
+    :param goods_allocations: array of shape (N, p, m) with goods allocations of N solutions
+    :return: array of shape (N) with cost of each solution
+    :raises IndexError: if any truck is allocated to crossing out of range
+    """
+    trucks_allocations, goods_allocations = np.asarray(trucks_allocations), np.asarray(goods_allocations)
+    duties, distances = np.asarray(settings.duties), np.asarray(settings.distances)
+    _check_trucks_allocations(trucks_allocations, settings)
+    costs = np.empty(goods_allocations.shape[0])
+    dtype = _float_dtype(goods_allocations, duties, distances)
+    _calc_costs_nb(
+        np.ascontiguousarray(trucks_allocations, dtype=trucks_allocation_dtype(settings)),
+        np.ascontiguousarray(goods_allocations, dtype=dtype),
+        np.ascontiguousarray(duties, dtype=dtype),
+        np.ascontiguousarray(distances, dtype=dtype),
+        float(settings.fuel_cost),
+        costs
+    )
+    return costs
 
 
 # ==========================================================
 #  RANDOM GENERATION
 # ==========================================================
-def generate_random_truck_allocation(settings: Settings) -> np.ndarray:
+@njit(cache=True)
+def _rebalance_nb(allocation, truck_capacity):
+    """
+    Moves (inplace) goods from the most loaded trucks to the least loaded trucks until no truck is overloaded.
+    Loads of trucks are calculated once and then updated only for the two trucks that changed, the most and the least
+    loaded trucks are tracked with heaps in which outdated entries are skipped when they reach the top.
+    """
+    trucks, goods_types = allocation.shape
+
+    sums = np.zeros(trucks, dtype=allocation.dtype)
+    for i in range(trucks):
+        for j in range(goods_types):
+            sums[i] += allocation[i, j]
+
+    max_heap = [(-sums[i], i) for i in range(trucks)]
+    min_heap = [(sums[i], i) for i in range(trucks)]
+    heapq.heapify(max_heap)
+    heapq.heapify(min_heap)
+
+    while True:
+        # find the most loaded truck
+        while -max_heap[0][0] != sums[max_heap[0][1]]:
+            heapq.heappop(max_heap)
+        k1 = max_heap[0][1]
+        if sums[k1] <= truck_capacity:
+            return
+        # find the least loaded truck
+        while min_heap[0][0] != sums[min_heap[0][1]]:
+            heapq.heappop(min_heap)
+        k2 = min_heap[0][1]
+        # select which of the goods to move
+        j = 0
+        for k in range(1, goods_types):
+            if allocation[k1, k] > allocation[k1, j]:
+                j = k
+        # calculate how much to move between trucks
+        excess = sums[k1] - truck_capacity
+        available = allocation[k1, j]
+        amount = available if available < excess else excess
+        # move from k1-th truck to k2-truck
+        allocation[k1, j] -= amount
+        allocation[k2, j] += amount
+        sums[k1] -= amount
+        sums[k2] += amount
+        # push new loads of both trucks, their previous entries became outdated
+        for i in (k1, k2):
+            heapq.heappush(max_heap, (-sums[i], i))
+            heapq.heappush(min_heap, (sums[i], i))
+
+
+@njit(cache=True, parallel=True)
+def _rebalance_all_nb(allocations, truck_capacity):
+    """ Rebalances (inplace) each goods allocation in block of shape (N, p, m), in parallel. """
+    for n in prange(allocations.shape[0]):
+        _rebalance_nb(allocations[n], truck_capacity)
+
+
+def generate_random_truck_allocation(settings: Settings, rng: Optional[np.random.Generator] = None) -> np.ndarray:
     """ Generates random truck """
-    return np.random.randint(low=0, high=settings.crossings_number, size=settings.trucks_number)
+    return generate_random_trucks_allocations(settings, 1, rng)[0]
+
+
+def generate_random_trucks_allocations(settings: Settings, size: int,
+                                       rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """ Generates array of shape (size, p) with random trucks allocations using given or default generator """
+    rng = _rng if rng is None else rng
+    return rng.integers(
+        0, settings.crossings_number, size=(size, settings.trucks_number), dtype=trucks_allocation_dtype(settings)
+    )
 
 
-def generate_random_goods_allocation(settings: Settings) -> np.ndarray:
+def generate_random_goods_allocation(settings: Settings, rng: Optional[np.random.Generator] = None) -> np.ndarray:
     """ Generates random goods allocation that meets restrictions (1, 2) """
+    return generate_random_goods_allocations(settings, 1, rng)[0]
+
+
+def generate_random_goods_allocations(settings: Settings, size: int,
+                                      rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Generates array of shape (size, p, m) with random goods allocations that meet restrictions (1, 2) using given
+    or default generator
+    """
+    rng = _rng if rng is None else rng
+    trucks_number, goods_types_number = settings.trucks_number, settings.goods_types_number
+    goods_amounts = np.ascontiguousarray(settings.goods_amounts)
 
     # check if there exists any proper allocation
-    if settings.trucks_number * settings.truck_capacity < settings.goods_amounts.sum():
+    if trucks_number * settings.truck_capacity < goods_amounts.sum():
         raise ValueError('Total amount of goods exceeds total capacity of trucks, therefore no solution exists')
 
-    # generate empty array
-    allocation = np.empty((settings.trucks_number, settings.goods_types_number))
+    # generate empty array, capacity is converted to its dtype so the repair kernel works on a single type
+    allocations = np.empty((size, trucks_number, goods_types_number), dtype=np.float32)
+    truck_capacity = allocations.dtype.type(settings.truck_capacity)
 
-    # ensure that restriction 2 is meet by generating values using multinomial distribution
-    for i in range(settings.goods_types_number):
-        allocation[:, i] = np.random.multinomial(
-            settings.goods_amounts[i],
-            np.ones(settings.trucks_number)/settings.trucks_number
-        )
+    # ensure that restriction 2 is meet by generating values using multinomial distribution, one type after another
+    # starting from the largest amounts, with probabilities proportional to capacity that is still left in each truck
+    # so that few trucks end up overloaded, large batches are drawn in chunks to bound memory used by draws
+    order = np.argsort(goods_amounts, kind='stable')[::-1]
+    for start in range(0, size, _GENERATION_CHUNK_SIZE):
+        chunk = allocations[start:start + _GENERATION_CHUNK_SIZE]
+        loads = np.zeros((len(chunk), trucks_number))
+        for i in order:
+            remaining = np.maximum(truck_capacity - loads, 0)
+            totals = remaining.sum(axis=1, keepdims=True)
+            probabilities = np.divide(
+                remaining, totals, out=np.full_like(remaining, 1/trucks_number), where=totals > 0
+            )
+            draws = rng.multinomial(goods_amounts[i], probabilities)
+            chunk[:, :, i] = draws
+            loads += draws
 
     # ensure that restriction 1 is meet by by moving goods from overloaded trucks to the most empty trucks
-    while np.any(allocation.sum(axis=1) > settings.truck_capacity):
-        # find the most and the least loaded trucks
-        sums = allocation.sum(axis=1)
-        k1 = sums.argmax()
-        k2 = sums.argmin()
-        # select which of the goods to move
-        j = allocation[k1].argmax()
-        # calculate how much to move between trucks
-        amount = min(allocation[k1, j], sums[k1]-settings.truck_capacity)
-        # move from k1-th truck to k2-truck
-        allocation[k1, j] -= amount
-        allocation[k2, j] += amount
+    _rebalance_all_nb(allocations, truck_capacity)
 
-    return allocation
+    return allocations
 
 
-def generate_random_solution(settings: Settings) -> Solution:
+def generate_random_solution(settings: Settings, rng: Optional[np.random.Generator] = None) -> Solution:
     """ Generates random solution that meets restrictions """
     solution = Solution(
-        trucks_allocation=generate_random_truck_allocation(settings),
-        goods_allocation=generate_random_goods_allocation(settings)
+        trucks_allocation=generate_random_truck_allocation(settings, rng),
+        goods_allocation=generate_random_goods_allocation(settings, rng)
     )
 
-    # ensure that generates solution meets restrictions
-    if not validate_solution(solution, settings):
-        raise RuntimeError('Generated solution does not meet restrictions')
+    # restrictions are met by construction, so they are checked only in debug mode (stripped by python -O)
+    assert validate_solution(solution, settings), 'Generated solution does not meet restrictions'
 
     return solution
 
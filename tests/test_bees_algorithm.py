@@ -0,0 +1,69 @@
+""" Checks that solver population stays consistent while simulating bees algorithm. """
+import math
+
+import numpy as np
+import pytest
+
+from goods_duty_optimizer import BeesSolver, Solution, generate_random_settings
+from goods_duty_optimizer.model import calculate_costs, validate_solution
+
+
+def _random_settings(rng: np.random.Generator, trucks_number: int, crossings_number: int, goods_types_number: int,
+                     slack: int):
+    """ Generates settings whose total goods fit into trucks with given spare capacity per truck. """
+    goods_amounts = rng.integers(1, 20, goods_types_number)
+    return generate_random_settings(
+        trucks_number=trucks_number,
+        crossings_number=crossings_number,
+        goods_types_number=goods_types_number,
+        truck_capacity=math.ceil(goods_amounts.sum() / trucks_number) + slack,
+        fuel_cost=rng.uniform(0.1, 10.0),
+        duties=rng.uniform(0.1, 10.0, (crossings_number, goods_types_number)),
+        distances=rng.uniform(1.0, 50.0, crossings_number),
+        goods_amounts=goods_amounts
+    )
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('trucks_number, crossings_number, goods_types_number, slack', [
+    (2, 2, 2, 0),       # no spare capacity, every goods mutation needs repair
+    (6, 4, 5, 3),
+    (10, 10, 10, 10),
+    (8, 200, 3, 1),     # trucks allocations stored as int16
+])
+def test_simulate_population_keeps_costs_and_restrictions(seed, trucks_number, crossings_number,
+                                                          goods_types_number, slack):
+    settings = _random_settings(np.random.default_rng(seed), trucks_number, crossings_number, goods_types_number, slack)
+    solver = BeesSolver(settings, population_size=20, goods_mutations=3, trucks_mutations=2, elite_sites=2,
+                        normal_sites=3, elite_site_size=4, normal_site_size=2, seed=seed)
+    solver.init_population()
+
+    for _ in range(50):
+        solver.simulate_population()
+
+        expected = calculate_costs(solver.trucks_population, solver.goods_population, solver.settings)
+        assert np.allclose(solver.costs, expected)
+        for trucks_allocation, goods_allocation in zip(solver.trucks_population, solver.goods_population):
+            assert validate_solution(Solution(trucks_allocation, goods_allocation), settings)
+
+
+def test_same_seed_gives_same_solution():
+    settings = _random_settings(np.random.default_rng(0), 6, 4, 5, 3)
+    solutions = []
+    for _ in range(2):
+        solver = BeesSolver(settings, population_size=20, goods_mutations=3, trucks_mutations=2, elite_sites=2,
+                            normal_sites=3, elite_site_size=4, normal_site_size=2, seed=1)
+        solutions.append(solver.find_best_solution(lambda loops, last_cost, new_cost: loops >= 20))
+
+    assert np.array_equal(solutions[0].trucks_allocation, solutions[1].trucks_allocation)
+    assert np.array_equal(solutions[0].goods_allocation, solutions[1].goods_allocation)
+
+
+def test_uninitialized_population_raises():
+    settings = _random_settings(np.random.default_rng(0), 6, 4, 5, 3)
+    solver = BeesSolver(settings, population_size=20, goods_mutations=3, trucks_mutations=2, elite_sites=2,
+                        normal_sites=3, elite_site_size=4, normal_site_size=2, seed=0)
+
+    for method in (solver.simulate_population, solver.current_cost, solver.current_solution):
+        with pytest.raises(IndexError):
+            method()
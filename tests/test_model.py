@@ -0,0 +1,26 @@
+""" Checks cost calculation on inputs given in other forms than prepared arrays. """
+import numpy as np
+import pytest
+
+from goods_duty_optimizer import Settings, Solution, calculate_cost
+from goods_duty_optimizer.model import calculate_costs
+
+SETTINGS = Settings(crossings_number=3, goods_types_number=2, trucks_number=3, truck_capacity=10, fuel_cost=1.5,
+                    duties=[[1, 2], [3, 4], [5, 6]], distances=[1, 2, 3], goods_amounts=[5, 6])
+
+
+def test_costs_of_array_likes():
+    solution = Solution([0, 1, 2], [[1, 2], [2, 2], [2, 2]])
+
+    assert calculate_cost(solution, SETTINGS) == pytest.approx(50.0)
+    assert np.allclose(calculate_costs([solution.trucks_allocation], [solution.goods_allocation], SETTINGS), [50.0])
+
+
+@pytest.mark.parametrize('crossing', [-1, 3, 259])
+def test_crossing_out_of_range_raises(crossing):
+    solution = Solution([0, 1, crossing], [[1, 2], [2, 2], [2, 2]])
+
+    with pytest.raises(IndexError):
+        calculate_cost(solution, SETTINGS)
+    with pytest.raises(IndexError):
+        calculate_costs([solution.trucks_allocation], [solution.goods_allocation], SETTINGS)